@@ -5,7 +5,9 @@ Date:at 13/04/2024
 version: 1.0.0
 Description: Toolbox to formulate the DeePC problem
 """
+import os
 import time
+import inspect
 import warnings
 import numpy as np
 import casadi as cs
@@ -14,6 +16,14 @@ import casadi.tools as ctools
 # packages from deepctools
 from . import util
 
+
+# The FFT-based product Uf * g replaces the dense work u_dim * Np * g_dim by about
+# (u_dim + 1) * N * log2(N), N the padded data length. It is used only if the dense work
+# is FFT_WORK_RATIO times larger, and at least FFT_MIN_WORK, below which the fixed
+# overhead of the FFT calls dominates (timed for u_dim 1-4, Np 16-512, T 400-64000).
+FFT_WORK_RATIO = 3
+FFT_MIN_WORK = 200000
+
 def timer(f):
     def wrapper(*args, **kwargs):
         start = time.time()
@@ -24,6 +34,44 @@ def timer(f):
     return wrapper
 
 
+# Attributes that define a formulated solver, saved and restored by `solver_cache`
+SOLVER_ATTRS = ('solver', 'lbc', 'ubc', '_isqp', '_H', '_A', '_F', '_f_const', '_f_params', '_neq', '_warm', '_batch')
+
+def _hashable(x):
+    """Convert (nested) solver options to a hashable key"""
+    if isinstance(x, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in x.items()))
+    if isinstance(x, (list, tuple)):
+        return tuple(_hashable(v) for v in x)
+    try:
+        hash(x)
+    except TypeError:
+        return repr(x)
+    return x
+
+def solver_cache(f):
+    """
+        Cache the solver formulated by f, keyed on the name of f and its arguments (uloss, opts, ...)
+        calling f again with the same arguments restores the cached solver instead of formulating it again
+    """
+    signature = inspect.signature(f)
+
+    def wrapper(self, *args, **kwargs):
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        key = (f.__name__,) + tuple(_hashable(v) for k, v in bound.arguments.items() if k != 'self')
+        if key in self._solver_cache:
+            print('>> Reuse the formulated solver')
+            for name, value in self._solver_cache[key].items():
+                setattr(self, name, value)
+            return
+        ret = f(self, *args, **kwargs)
+        self._solver_cache[key] = {name: getattr(self, name, None) for name in SOLVER_ATTRS}
+        return ret
+
+    return wrapper
+
+
 class deepctools():
     """
          ----------------------------------------------------------------------------------------------------------
@@ -48,14 +96,15 @@ class deepctools():
                     ylb <= y <= yub                       |  uloss = (u)   or    (u - uref)    or    (du)
          ----------------------------------------------------------------------------------------------------------
                         Functions                |                            Usage
-            initialize_DeePCsolver(uloss, opts)  |  construct DeePC solver
-            initialize_RDeePCsolver(uloss, opts) |  construct Robust DeePC solver
+            initialize_DeePCsolver(uloss, opts, qpsol, jit)  |  construct DeePC solver
+            initialize_RDeePCsolver(uloss, opts, qpsol, jit) |  construct Robust DeePC solver
             solver_step(uini, yini)    |  solve the optimization problem one step
+            solver_batch(uini, yini, n_threads)  |  solve the optimization problem for a batch of uini, yini in one call
          ----------------------------------------------------------------------------------------------------------
     """
 
     def __init__(self, u_dim, y_dim, T, Tini, Np, ud, yd, Q, R, lambda_g=None, lambda_y=None,
-                 sp_change=False, us=None, ys=None, ineqconidx=None, ineqconbd=None, svd=False):
+                 sp_change=False, us=None, ys=None, ineqconidx=None, ineqconbd=None, svd=False, check_pe=True):
         """
             ------Initialize the system parameters and DeePC config------
                  u_dim: [int]             |  the dimension of control inputs
@@ -81,6 +130,8 @@ class deepctools():
                    svd: [bool]            |  whether use SVD-based dimension reduction for DeePC
                                           |      if True, the second dimension of Hankel matrix and dimension of g 
                                           |      will be reduced to `the rank of the Hankel matrix with ud, and yd: rank([Hud, Hyd])`
+              check_pe: [bool]            |  whether check the rank condition of PE at initialization, requires a SVD of Hankel matrix of ud
+                                          |      which is the most expensive step for large T, can be skipped for checked offline data
         """
 
         self.u_dim = u_dim
@@ -96,12 +147,14 @@ class deepctools():
         self.ys = ys
         self.sp_change = sp_change
         self.svd = svd
+        self.check_pe = check_pe
         self.ud = ud
         self.yd = yd
         if not sp_change:
-            self.yref = np.tile(ys, (Np, 1)).reshape(-1, 1)
+            # repeat the set-points over Np steps as a broadcast view, only materialized by the final reshape
+            self.yref = np.broadcast_to(np.reshape(ys, (1, -1)), (Np, np.size(ys))).reshape(-1, 1)
             if us.any():
-                self.uref = np.tile(us, (Np, 1)).reshape(-1, 1)
+                self.uref = np.broadcast_to(np.reshape(us, (1, -1)), (Np, np.size(us))).reshape(-1, 1)
             else:
                 self.uref = None
 
@@ -119,18 +172,40 @@ class deepctools():
         self.g_dim = T - Tini - Np + 1 if not self.svd else rank
         self.lambda_g = self.lambda_g[:self.g_dim, :self.g_dim] if self.svd else self.lambda_g
 
+        # contiguous float64 arrays, so that the matrix products are computed by BLAS (dgemm/dgemv)
+        self.Up, self.Uf, self.Yp, self.Yf = map(self._asfloat, (self.Up, self.Uf, self.Yp, self.Yf))
+        self.Q, self.R, self.lambda_g, self.lambda_y = map(self._asfloat, (self.Q, self.R, self.lambda_g, self.lambda_y))
+
         # check variable size
         self._checkvar()
 
+        # precompute the products for the Hessian of the QP problems, the data matrices are fixed after initialization
+        self._init_hessian()
+
         # init inequality constrains
         self.Hc, self.lbc_ineq, self.ubc_ineq = self._init_ineq_cons(ineqconidx, ineqconbd)
 
+        # pseudo-inverse of [Up; Yp] for the initial guess of g, fixed after initialization
+        self._UpYp_pinv = np.linalg.pinv(np.concatenate((self.Up, self.Yp), axis=0))
+
+        # spectrum of ud for the FFT-based product u = Uf * g, Uf is Hankel only if svd=False
+        N = 1 << int(np.ceil(np.log2(self.T - self.Tini)))
+        dense_work = self.u_dim * self.Np * self.g_dim
+        fft_work = (self.u_dim + 1) * N * np.log2(N)
+        if not self.svd and dense_work >= max(FFT_WORK_RATIO * fft_work, FFT_MIN_WORK):
+            self._Uf_fft = util.hankel_fft(np.asarray(ud)[self.Tini:], self.Np)
+        else:
+            self._Uf_fft = None
+
         # init the casadi variables
         self._init_variables()
 
         self.solver = None
         self.lbc = None
         self.ubc = None
+        self._isqp = False
+        self._batch = {}
+        self._solver_cache = {}
 
 
     def _checkvar(self):
@@ -148,10 +223,7 @@ class deepctools():
             lambda_g           |  (T-L+1, T-L+1)
             lambda_y           |  (dim*Tini, dim*Tini)
             ------------------------------------------------------------------
-            Persistently Excitation condition:
-                1. g_dim >= u_dim * (Tini + Np)
-                2. the Hankel matrix of ud should be full row rank
-                   which is u_dim * (Tini + Np)
+            Persistently Excitation condition:  see _checkPE
             ------------------------------------------------------------------
         """
         self._checkshape(self.Up, tuple([self.u_dim * self.Tini, self.g_dim]))
@@ -167,8 +239,23 @@ class deepctools():
         self._checkshape(self.lambda_y, tuple([self.y_dim * self.Tini, self.y_dim * self.Tini]))
 
         # Check PE condition
+        self._checkPE()
+
+
+    def _checkPE(self):
+        """
+            ------------------------------------------------------------------
+            Persistently Excitation condition:
+                1. g_dim >= u_dim * (Tini + Np)
+                2. the Hankel matrix of ud should be full row rank
+                   which is u_dim * (Tini + Np)
+            ------------------------------------------------------------------
+            the rank condition requires a SVD of the Hankel matrix of ud, only checked if check_pe=True
+        """
         if self.g_dim < self.u_dim * (self.Tini + self.Np):
             warnings.warn("Persistently Excitation (PE) condition not satisfied! Should g_dim >= u_dim * (Tini + Np)")
+        if not self.check_pe:
+            return
         if not self.svd:
             Hud_rank = np.linalg.matrix_rank(self.Hud) 
         else:
@@ -177,6 +264,71 @@ class deepctools():
             warnings.warn(f"Persistently Excitation (PE) condition not satisfied! Should Hankel matrix of ud is full row rank: u_dim * (Tini + Np) := {self.u_dim * (self.Tini + self.Np)} != {Hud_rank}!")
 
 
+    def _init_hessian(self):
+        """
+            Precompute the constant products for the Hessian H of the QP problems
+                DeePC:         H = Yf' Q Yf + Uf' R Uf
+                Robust DeePC:  H = Yf' Q Yf + Uf' R Uf + Yp' lambda_y Yp + lambda_g
+            the linear term f = - Yf' Q yref - Uf' R uref (- Yp' lambda_y yini) reuses the products
+            diagonal lambda_y, lambda_g (e.g., lambda * I) are applied as scaling instead of matrix products
+            H is (g_dim, g_dim), only built when a QP is formulated, see H_deepc, H_rdeepc
+        """
+        self._YfTQ = self.Yf.T @ self.Q
+        self._UfTR = self.Uf.T @ self.R
+        self._lambda_g_diag = self._diagonal(self.lambda_g)
+        self._lambda_y_diag = self._diagonal(self.lambda_y)
+        if self.lambda_g is not None and self.lambda_y is not None:
+            if self._lambda_y_diag is not None:
+                self._YpTLy = self.Yp.T * self._lambda_y_diag
+            else:
+                self._YpTLy = self.Yp.T @ self.lambda_y
+        else:
+            self._YpTLy = None
+        self._H_deepc = None
+        self._H_rdeepc = None
+
+
+    def _hessian(self):
+        """Hessian of DeePC as numpy array:  H = Yf' Q Yf + Uf' R Uf"""
+        H = self._YfTQ @ self.Yf + self._UfTR @ self.Uf
+        return 0.5 * (H + H.T)  # remove the round-off asymmetry, H is symmetric by definition
+
+
+    @property
+    def H_deepc(self):
+        """Hessian of DeePC as casadi DM, built at the first use"""
+        if self._H_deepc is None:
+            self._H_deepc = cs.DM(self._hessian())
+        return self._H_deepc
+
+
+    @property
+    def H_rdeepc(self):
+        """Hessian of Robust DeePC as casadi DM, built at the first use, None if lambda_g or lambda_y not given"""
+        if self._H_rdeepc is None and self._YpTLy is not None:
+            H_r = self._YpTLy @ self.Yp
+            if self._lambda_g_diag is not None:
+                H_r[np.diag_indices_from(H_r)] += self._lambda_g_diag
+            else:
+                H_r += self.lambda_g
+            self._H_rdeepc = cs.DM(self._hessian() + 0.5 * (H_r + H_r.T))
+        return self._H_rdeepc
+
+
+    @staticmethod
+    def _diagonal(x):
+        """Return the diagonal of the matrix if it is diagonal, otherwise None"""
+        if x is None or np.count_nonzero(x - np.diag(np.diag(x))) > 0:
+            return None
+        return np.diag(x).copy()
+
+
+    @staticmethod
+    def _asfloat(x):
+        """Convert the variable to a C-contiguous float64 array"""
+        return None if x is None else np.ascontiguousarray(x, dtype=np.float64)
+
+
     def _checkshape(self, x, x_shape):
         """Check if the variable has the correct shape"""
         if x is not None:
@@ -206,37 +358,41 @@ class deepctools():
             Obtain Hankel matrix that used for the inequality constrained variables
                            lbc <= Hc * g <= ubc
             return  Hc, lbc, ubc
+            the rows of Uf, Yf stacked in Hc are kept in self._Hc_idx, e.g., {'u': rows of Uf, 'y': rows of Yf}
         """
+        self._Hc_idx = {}
         if ineqconidx is None:
             print(">> DeePC design have no constraints on 'u' and 'y'.")
-            Hc, lbc, ubc = [], [], []
+            Hc, lbc, ubc = np.zeros((0, self.g_dim)), np.zeros(0), np.zeros(0)
         else:
             Hc_list = []
             lbc_list = []
             ubc_list = []
             for varname, idx in ineqconidx.items():
                 if varname == 'u':
-                    H_all = self.Uf.copy()
+                    H_all = self.Uf
                     dim = self.u_dim
                     lb = ineqconbd['lbu']
                     ub = ineqconbd['ubu']
                 elif varname == 'y':
-                    H_all = self.Yf.copy()
+                    H_all = self.Yf
                     dim = self.y_dim
                     lb = ineqconbd['lby']
                     ub = ineqconbd['uby']
                 else:
                     raise ValueError("%s variable not exist, should be 'u' or/and 'y'!" % varname)
 
-                idx_H = [v + i * dim for i in range(self.Np) for v in idx]
+                # rows of the constrained variables in each of the Np steps; fancy indexing returns a new array
+                idx_H = (np.arange(self.Np)[:, None] * dim + np.asarray(idx, dtype=int)[None, :]).ravel()
                 Hc_list.append(H_all[idx_H, :])
-                lbc_list.append(np.tile(lb, self.Np))
-                ubc_list.append(np.tile(ub, self.Np))
+                self._Hc_idx[varname] = idx_H.tolist()
+                lbc_list.append(np.broadcast_to(lb, (self.Np, len(idx))).ravel())
+                ubc_list.append(np.broadcast_to(ub, (self.Np, len(idx))).ravel())
 
             Hc = np.concatenate(Hc_list)
-            lbc = np.concatenate(lbc_list).flatten()
-            ubc = np.concatenate(ubc_list).flatten()
-        return Hc, lbc.tolist(), ubc.tolist()
+            lbc = np.concatenate(lbc_list).astype(float)
+            ubc = np.concatenate(ubc_list).astype(float)
+        return Hc, lbc, ubc
 
 
     def _init_variables(self):
@@ -267,7 +423,8 @@ class deepctools():
 
 
     @timer
-    def init_DeePCsolver(self, uloss='u', opts={}):
+    @solver_cache
+    def init_DeePCsolver(self, uloss='u', opts={}, qpsol='osqp', jit=False):
         """
                               Formulate NLP solver for: DeePC design
             Initialize CasADi nlp solver, !!! only need to formulate the nlp problem at the first time !!!
@@ -290,6 +447,17 @@ class deepctools():
                                             # 'ipopt.acceptable_tol': 1e-8,
                                             # 'ipopt.acceptable_obj_change_tol': 1e-6,
                                         }
+                   the IPOPT options apply to uloss "du", or to all uloss if qpsol=None
+                   for the QP problems of uloss "u" and "uus" solved by qpsol, give the options of the QP solver,
+                   e.g.:         opts = {'osqp.eps_abs': 1e-6, 'osqp.max_iter': 4000, 'print_time': 0}
+                   the IPOPT options are ignored by qpsol with a warning
+            qpsol: the QP solver of casadi.conic for uloss "u" and "uus", e.g., 'osqp'
+                   the QP is formulated with numeric H and A, and only the linear term f and the bounds
+                   are updated at each time
+                   notice the Hessian of DeePC is only positive semi-definite, which is handled by 'osqp',
+                   active-set solvers, e.g., 'qpoases', 'daqp', may fail on it, a warning is given if the QP fails
+                   if None, the QP problems are solved by IPOPT as well
+              jit: whether compile the nlp functions of IPOPT into C code with CasADi JIT (requires a C compiler)
             -----------------------------------------------------------------------------------------------
             g_dim:
                 if DeePC:
@@ -314,6 +482,9 @@ class deepctools():
             uref, yref = self.uref, self.yref
         g, = self.optimizing_target[...]  # data are stored in list [], notice that ',' cannot be missed
 
+        # numeric matrices as casadi DM, so that the nlp is built from SX and DM only, structural zeros are dropped
+        Up, Yp, Uf, Yf, Hc, Q, R = map(util.sparse_dm, (self.Up, self.Yp, self.Uf, self.Yf, self.Hc, self.Q, self.R))
+
         ## J  =  || Uf * g - ys ||_Q^2 + || uloss ||_R^2
         ## s.t.   Up * g = uini
         ##        Yp * g = yini
@@ -322,55 +493,65 @@ class deepctools():
         ## objective function in QP form
         if uloss == 'u':
             ## QP problem
-            H = self.Yf.T @ self.Q @ self.Yf + self.Uf.T @ self.R @ self.Uf
-            f = - self.Yf.T @ self.Q @ yref  # - self.Uf.T @ self.R @ uref
+            H = self.H_deepc
+            Fy, Fu = - self._YfTQ, None
+            if qpsol is not None:
+                self._init_qpsolver(qpsol, opts, H, cs.vertcat(Up, Yp, Hc), Fy, Fu)
+                return
+            f = Fy @ yref  # - self.Uf.T @ self.R @ uref
             obj = 0.5 * cs.mtimes(cs.mtimes(g.T, H), g) + cs.mtimes(f.T, g)
 
         if uloss == 'uus':
             if self.sp_change is False and self.uref is None:
                 raise ValueError("Do not give value of 'us', but required in objective function 'u-us'!")
             ## QP problem
-            H = self.Yf.T @ self.Q @ self.Yf + self.Uf.T @ self.R @ self.Uf
-            f = - self.Yf.T @ self.Q @ yref - self.Uf.T @ self.R @ uref
+            H = self.H_deepc
+            Fy, Fu = - self._YfTQ, - self._UfTR
+            if qpsol is not None:
+                self._init_qpsolver(qpsol, opts, H, cs.vertcat(Up, Yp, Hc), Fy, Fu)
+                return
+            f = Fy @ yref + Fu @ uref
             obj = 0.5 * cs.mtimes(cs.mtimes(g.T, H), g) + cs.mtimes(f.T, g)
 
         if uloss == 'du':
             ## Not a QP problem
-            u_cur = cs.mtimes(self.Uf, g)
-            u_prev = cs.vertcat(uini[-self.u_dim:], cs.mtimes(self.Uf, g)[:-self.u_dim])
+            Uf_g = cs.mtimes(Uf, g)
+            u_cur = Uf_g
+            u_prev = cs.vertcat(uini[-self.u_dim:], Uf_g[:-self.u_dim])
             du = u_cur - u_prev
 
-            y = cs.mtimes(self.Yf, g)
+            y = cs.mtimes(Yf, g)
             y_loss = y - yref
-            obj = cs.mtimes(cs.mtimes(y_loss.T, self.Q), y_loss) + cs.mtimes(cs.mtimes(du.T, self.R), du)
+            obj = cs.mtimes(cs.mtimes(y_loss.T, Q), y_loss) + cs.mtimes(cs.mtimes(du.T, R), du)
 
         #### constrains
         C = []
-        lbc, ubc = [], []
         # equal constrains:  Up * g = uini, Yp * g = yini
-        C += [cs.mtimes(self.Up, g) - uini]
-        for i in range(uini.shape[0]):
-            lbc += [0]
-            ubc += [0]
-        C += [cs.mtimes(self.Yp, g) - yini]
-        for i in range(yini.shape[0]):
-            lbc += [0]
-            ubc += [0]
+        n_eq = self.u_dim * self.Tini + self.y_dim * self.Tini
+        C += [cs.mtimes(Up, g) - uini]
+        C += [cs.mtimes(Yp, g) - yini]
 
         # inequality constrains:    ulb <= Uf_u * g <= uub --> only original u
-        C += [cs.mtimes(self.Hc, g)]
-        lbc.extend(self.lbc_ineq)
-        ubc.extend(self.ubc_ineq)
+        if uloss == 'du':
+            # Hc * g are rows of Uf * g and Yf * g, which are already in the objective
+            C += [Uf_g[idx] if varname == 'u' else y[idx] for varname, idx in self._Hc_idx.items()]
+        else:
+            C += [cs.mtimes(Hc, g)]
+        lbc = np.concatenate((np.zeros(n_eq), self.lbc_ineq))
+        ubc = np.concatenate((np.zeros(n_eq), self.ubc_ineq))
 
         # formulate the nlp prolbem
         nlp_prob = {'f': obj, 'x': self.optimizing_target, 'p': self.parameters, 'g': cs.vertcat(*C)}
 
-        self.solver = cs.nlpsol('solver', 'ipopt', nlp_prob, opts)
+        self.solver = cs.nlpsol('solver', 'ipopt', nlp_prob, self._nlpsol_opts(opts, jit))
         self.lbc = lbc
         self.ubc = ubc
+        self._isqp = False
+        self._batch = {}
 
     @timer
-    def init_RDeePCsolver(self, uloss='u', opts={}):
+    @solver_cache
+    def init_RDeePCsolver(self, uloss='u', opts={}, qpsol='osqp', jit=False):
         """
                               Formulate NLP solver for: Robust DeePC design
             Initialize CasADi nlp solver, !!! only need to formulate the nlp problem at the first time !!!
@@ -393,6 +574,17 @@ class deepctools():
                                             # 'ipopt.acceptable_tol': 1e-8,
                                             # 'ipopt.acceptable_obj_change_tol': 1e-6,
                                         }
+                   the IPOPT options apply to uloss "du", or to all uloss if qpsol=None
+                   for the QP problems of uloss "u" and "uus" solved by qpsol, give the options of the QP solver,
+                   e.g.:         opts = {'osqp.eps_abs': 1e-6, 'osqp.max_iter': 4000, 'print_time': 0}
+                   the IPOPT options are ignored by qpsol with a warning
+            qpsol: the QP solver of casadi.conic for uloss "u" and "uus", e.g., 'osqp'
+                   the QP is formulated with numeric H and A, and only the linear term f and the bounds
+                   are updated at each time
+                   notice the Hessian of DeePC is only positive semi-definite, which is handled by 'osqp',
+                   active-set solvers, e.g., 'qpoases', 'daqp', may fail on it, a warning is given if the QP fails
+                   if None, the QP problems are solved by IPOPT as well
+              jit: whether compile the nlp functions of IPOPT into C code with CasADi JIT (requires a C compiler)
             ----------------------------------------------------------------------------------------------
             g_dim:
                 if DeePC:
@@ -421,6 +613,12 @@ class deepctools():
             uref, yref = self.uref, self.yref
         g, = self.optimizing_target[...]  # data are stored in list [], notice that ',' cannot be missed
 
+        # numeric matrices as casadi DM, so that the nlp is built from SX and DM only, structural zeros are dropped
+        Up, Yp, Uf, Yf, Hc, Q, R = map(util.sparse_dm, (self.Up, self.Yp, self.Uf, self.Yf, self.Hc, self.Q, self.R))
+        # diagonal weights as sparse diagonal DM
+        lambda_g = cs.diag(self._lambda_g_diag) if self._lambda_g_diag is not None else cs.DM(self.lambda_g)
+        lambda_y = cs.diag(self._lambda_y_diag) if self._lambda_y_diag is not None else cs.DM(self.lambda_y)
+
         ## J  =  || Uf * g - ys ||_Q^2 + || uloss ||_R^2 + lambda_y || Yp * g - yini||_2^2 + lambda_g || g ||_2^2
         ## s.t.   Up * g = uini
         ##        ulb <= u <= uub
@@ -428,52 +626,120 @@ class deepctools():
         ## objective function
         if uloss == 'u':
             ## QP problem
-            H = self.Yf.T @ self.Q @ self.Yf + self.Uf.T @ self.R @ self.Uf + self.Yp.T @ self.lambda_y @ self.Yp + self.lambda_g
-            f = - self.Yp.T @ self.lambda_y @ yini - self.Yf.T @ self.Q @ yref  # - self.Uf.T @ self.R @ uref
+            H = self.H_rdeepc
+            Fy, Fu, Fyini = - self._YfTQ, None, - self._YpTLy
+            if qpsol is not None:
+                self._init_qpsolver(qpsol, opts, H, cs.vertcat(Up, Hc), Fy, Fu, Fyini)
+                return
+            f = Fyini @ yini + Fy @ yref  # - self.Uf.T @ self.R @ uref
             obj = 0.5 * cs.mtimes(cs.mtimes(g.T, H), g) + cs.mtimes(f.T, g)
 
         if uloss == 'uus':
             if self.sp_change is False and self.uref is None:
                 raise ValueError("Do not give value of 'us', but required in objective function 'u-us'!")
             ## QP problem
-            H = self.Yf.T @ self.Q @ self.Yf + self.Uf.T @ self.R @ self.Uf + self.Yp.T @ self.lambda_y @ self.Yp + self.lambda_g
-            f = - self.Yp.T @ self.lambda_y @ yini - self.Yf.T @ self.Q @ yref - self.Uf.T @ self.R @ uref
+            H = self.H_rdeepc
+            Fy, Fu, Fyini = - self._YfTQ, - self._UfTR, - self._YpTLy
+            if qpsol is not None:
+                self._init_qpsolver(qpsol, opts, H, cs.vertcat(Up, Hc), Fy, Fu, Fyini)
+                return
+            f = Fyini @ yini + Fy @ yref + Fu @ uref
             obj = 0.5 * cs.mtimes(cs.mtimes(g.T, H), g) + cs.mtimes(f.T, g)
 
         if uloss == 'du':
             ## Not a QP problem
-            u_cur = cs.mtimes(self.Uf, g)
-            u_prev = cs.vertcat(uini[-self.u_dim:], cs.mtimes(self.Uf, g)[:-self.u_dim])
+            Uf_g = cs.mtimes(Uf, g)
+            u_cur = Uf_g
+            u_prev = cs.vertcat(uini[-self.u_dim:], Uf_g[:-self.u_dim])
             du = u_cur - u_prev
 
-            y = cs.mtimes(self.Yf, g)
+            y = cs.mtimes(Yf, g)
             y_loss = y - yref
 
-            sigma_y = cs.mtimes(self.Yp, g) - yini
-            obj = cs.mtimes(cs.mtimes(y_loss.T, self.Q), y_loss) + cs.mtimes(cs.mtimes(du.T, self.R), du) + cs.mtimes(
-                cs.mtimes(g.T, self.lambda_g), g) + cs.mtimes(cs.mtimes(sigma_y.T, self.lambda_y), sigma_y)
+            sigma_y = cs.mtimes(Yp, g) - yini
+            obj = cs.mtimes(cs.mtimes(y_loss.T, Q), y_loss) + cs.mtimes(cs.mtimes(du.T, R), du) + cs.mtimes(
+                cs.mtimes(g.T, lambda_g), g) + cs.mtimes(cs.mtimes(sigma_y.T, lambda_y), sigma_y)
 
         #### constrains
         C = []
-        lbc, ubc = [], []
-        # equal constrains:  Up * g = uini, Yp * g = yini
-        C += [cs.mtimes(self.Up, g) - uini]
-        for i in range(uini.shape[0]):
-            lbc += [0]
-            ubc += [0]
+        # equal constrains:  Up * g = uini
+        n_eq = self.u_dim * self.Tini
+        C += [cs.mtimes(Up, g) - uini]
 
         # inequality constrains:    ulb <= Uf_u * g <= uub --> only original u
-        C += [cs.mtimes(self.Hc, g)]
-        lbc.extend(self.lbc_ineq)
-        ubc.extend(self.ubc_ineq)
+        if uloss == 'du':
+            # Hc * g are rows of Uf * g and Yf * g, which are already in the objective
+            C += [Uf_g[idx] if varname == 'u' else y[idx] for varname, idx in self._Hc_idx.items()]
+        else:
+            C += [cs.mtimes(Hc, g)]
+        lbc = np.concatenate((np.zeros(n_eq), self.lbc_ineq))
+        ubc = np.concatenate((np.zeros(n_eq), self.ubc_ineq))
 
         # formulate the nlp prolbem
         nlp_prob = {'f': obj, 'x': self.optimizing_target, 'p': self.parameters, 'g': cs.vertcat(*C)}
 
-        self.solver = cs.nlpsol('solver', 'ipopt', nlp_prob, opts)
+        self.solver = cs.nlpsol('solver', 'ipopt', nlp_prob, self._nlpsol_opts(opts, jit))
         self.lbc = lbc
         self.ubc = ubc
-        
+        self._isqp = False
+        self._batch = {}
+
+
+    def _nlpsol_opts(self, opts, jit=False):
+        """
+            Default options of the IPOPT solver, the options given by user have priority
+                 expand: expand the nlp functions to SX graph, which is faster to evaluate and differentiate
+                    jit: compile the nlp functions with "-O3" by the shell compiler, compiled once at formulation
+        """
+        default_opts = {'expand': True}
+        if jit:
+            default_opts.update({'jit': True, 'compiler': 'shell', 'jit_options': {'flags': ['-O3'], 'verbose': False}})
+        return {**default_opts, **opts}
+
+
+    def _init_qpsolver(self, qpsol, opts, H, A, Fy, Fu=None, Fyini=None):
+        """
+            Formulate the QP solver with casadi.conic for uloss "u" and "uus"
+                    min  0.5 * g' H g + f' g
+                    s.t.  lba <= A * g <= uba
+            H, A are numeric and fixed, the parameters only enter the linear term and the bounds:
+                    f = Fy * yref + Fu * uref + Fyini * yini  =  f_const + F * [yini, yref, uref]
+                with the fixed set-points folded into f_const, and F only acting on the changing parameters
+                  lba = [uini, yini, lbc],  uba = [uini, yini, ubc]  |  DeePC
+                  lba = [uini, lbc],        uba = [uini, ubc]        |  Robust DeePC
+            so the factorization of the QP solver is kept, and each solve is warm started
+            from the primal and dual solution of the previous step
+            the options of IPOPT in opts (e.g., 'ipopt.print_level', 'expand') are dropped with a warning
+        """
+        ipopt_keys = [key for key in opts if key.startswith('ipopt.') or key == 'expand']
+        if ipopt_keys:
+            warnings.warn(f"Options {ipopt_keys} are for IPOPT and ignored by the QP solver '{qpsol}', set qpsol=None to solve the QP by IPOPT!")
+            opts = {key: value for key, value in opts.items() if key not in ipopt_keys}
+        if qpsol == 'osqp':
+            opts = {'osqp.eps_abs': 1e-6, 'osqp.eps_rel': 1e-6, 'osqp.polish': True, 'osqp.verbose': False, **opts}
+        opts = {'error_on_fail': False, **opts}
+        self._H = H
+        self._A = cs.DM(A)
+        # linear term f = f_const + F * p, p stacks the parameters that change at each step
+        self._f_params = ['yini'] if Fyini is not None else []
+        F = [Fyini] if Fyini is not None else []
+        if self.sp_change:
+            self._f_params += ['yref', 'uref'] if Fu is not None else ['yref']
+            F += [Fy, Fu] if Fu is not None else [Fy]
+            self._f_const = np.zeros((self.g_dim, 1))
+        else:
+            self._f_const = Fy @ self.yref + (Fu @ self.uref if Fu is not None else 0)
+        self._F = np.hstack(F) if F else None
+        self._neq = A.shape[0] - len(self.lbc_ineq)
+
+        self.solver = cs.conic('solver', qpsol, {'h': self._H.sparsity(), 'a': self._A.sparsity()}, opts)
+        # the equality rows are updated in place with uini (, yini) at each step
+        self.lbc = np.concatenate((np.zeros(self._neq), self.lbc_ineq))
+        self.ubc = np.concatenate((np.zeros(self._neq), self.ubc_ineq))
+        self._isqp = True
+        self._warm = None
+        self._batch = {}
+
 
     def solver_step(self, uini, yini, uref=None, yref=None):
         """
@@ -489,15 +755,130 @@ class deepctools():
         if self.sp_change:
             if uref is None or yref is None:
                 raise ValueError("Do not give value of 'uref' or 'yref', but required in objective function!")
-            parameters = np.concatenate((uini, yini, uref, yref))
+        # stacked as column, so that both (dim*Tini, 1) and (dim*Tini, ) inputs are accepted
+        uyini = np.concatenate((uini, yini)).reshape(-1, 1)
+
+        if self._isqp:
+            if self._F is None:
+                f = self._f_const
+            else:
+                p = {'yini': yini, 'yref': yref, 'uref': uref}
+                f = self._f_const + self._F @ np.concatenate([p[name] for name in self._f_params]).reshape(-1, 1)
+            # equality rows: Up * g = uini (, Yp * g = yini)
+            self.lbc[:self._neq] = uyini.ravel()[:self._neq]
+            self.ubc[:self._neq] = uyini.ravel()[:self._neq]
+            warm = self._warm if self._warm is not None else {'x0': self._UpYp_pinv @ uyini}
         else:
-            parameters = np.concatenate((uini, yini))
-        g0_guess = np.linalg.pinv(np.concatenate((self.Up, self.Yp), axis=0)) @ np.concatenate((uini, yini))
+            parameters = np.concatenate((uini, yini, uref, yref)) if self.sp_change else uyini
+            g0_guess = self._UpYp_pinv @ uyini
 
         t_ = time.time()
-        sol = self.solver(x0=g0_guess, p=parameters, lbg=self.lbc, ubg=self.ubc)
+        if self._isqp:
+            sol = self.solver(h=self._H, g=f, a=self._A, lba=self.lbc, uba=self.ubc, **warm)
+        else:
+            sol = self.solver(x0=g0_guess, p=parameters, lbg=self.lbc, ubg=self.ubc)
         t_s = time.time() - t_
 
+        if self._isqp:
+            # warm start the next step only from a successful solve, otherwise from the pinv guess again
+            if self.solver.stats()['success']:
+                self._warm = {'x0': sol['x'], 'lam_a0': sol['lam_a'], 'lam_x0': sol['lam_x']}
+            else:
+                self._warm = None
+                warnings.warn(f"QP solver failed with return status '{self.solver.stats()['return_status']}'!")
+
         g_opt = sol['x'].full().ravel()
+        if self._Uf_fft is not None:
+            u_opt = util.hankel_matvec(self._Uf_fft, g_opt, self.Np)
+        else:
+            u_opt = np.matmul(self.Uf, g_opt)
+        return u_opt, g_opt, t_s
+
+    def _init_batch(self, N, n_threads):
+        """
+            Wrap one solve of the formulated solver as casadi Function of (uini, yini [, uref, yref]) -> g,
+            and map it over N columns, the Function is kept for the same N, n_threads
+            the columns are evaluated by n_threads threads for the QP solver, but in serial for IPOPT,
+            since IPOPT and its linear solver MUMPS are not thread-safe
+        """
+        if not self._isqp:
+            n_threads = 1
+        key = (N, n_threads)
+        if key in self._batch:
+            return self._batch[key]
+        uini = cs.MX.sym('uini', self.u_dim * self.Tini)
+        yini = cs.MX.sym('yini', self.y_dim * self.Tini)
+        uref = cs.MX.sym('uref', self.u_dim * self.Np)
+        yref = cs.MX.sym('yref', self.y_dim * self.Np)
+        inputs = [uini, yini, uref, yref] if self.sp_change else [uini, yini]
+        uyini = cs.vertcat(uini, yini)
+        g0_guess = cs.mtimes(cs.DM(self._UpYp_pinv), uyini)
+
+        if self._isqp:
+            p = {'yini': yini, 'yref': yref, 'uref': uref}
+            f = cs.DM(self._f_const)
+            if self._F is not None:
+                f = f + cs.mtimes(cs.DM(self._F), cs.vertcat(*[p[name] for name in self._f_params]))
+            lba = cs.vertcat(uyini[:self._neq], cs.DM(self.lbc[self._neq:]))
+            uba = cs.vertcat(uyini[:self._neq], cs.DM(self.ubc[self._neq:]))
+            sol = self.solver(h=self._H, g=f, a=self._A, lba=lba, uba=uba, x0=g0_guess)
+        else:
+            parameters = cs.vertcat(uyini, uref, yref) if self.sp_change else uyini
+            sol = self.solver(x0=g0_guess, p=parameters, lbg=self.lbc, ubg=self.ubc)
+
+        solver_fn = cs.Function('deepc_step', inputs, [sol['x']])
+        self._batch[key] = solver_fn.map(N, 'thread', n_threads) if self._isqp else solver_fn.map(N, 'serial')
+        return self._batch[key]
+
+    def solver_batch(self, uini, yini, uref=None, yref=None, n_threads=None, tol=1e-4):
+        """
+            solver solve the optimization problem for a batch of initial trajectories in one call,
+            each column is an independent problem as in solver_step, without warm start between the columns
+             uini, yini:  [array]   | (dim*Tini, N)
+             uref, yref:  [array]   | (dim*Np, N) if sp_change=True
+              n_threads:  [int]     | number of threads for the QP solver, default the number of CPUs
+                                    |     the problems solved by IPOPT are always solved in serial
+                    tol:  [float]   | tolerance of the feasibility check of the solutions
+                                    |     the status of each solve is not available from the mapped solver,
+                                    |     instead a warning is given for the columns that violate
+                                    |     Up * g = uini (, Yp * g = yini) or lbc <= Hc * g <= ubc by more than tol
+            return:
+                u_opt:  the optimized control inputs for the next Np steps, (u_dim*Np, N)
+                g_opt:  the optimized operator g, (g_dim, N)
+                  t_s:  solving time of the whole batch
+        """
+        if self.sp_change:
+            if uref is None or yref is None:
+                raise ValueError("Do not give value of 'uref' or 'yref', but required in objective function!")
+        uini = np.reshape(uini, (self.u_dim * self.Tini, -1))
+        yini = np.reshape(yini, (self.y_dim * self.Tini, -1))
+        N = uini.shape[1]
+        inputs = [uini, yini]
+        if self.sp_change:
+            inputs += [np.reshape(uref, (self.u_dim * self.Np, N)), np.reshape(yref, (self.y_dim * self.Np, N))]
+        batched = self._init_batch(N, n_threads or os.cpu_count())
+
+        t_ = time.time()
+        g_opt = batched(*inputs)
+        t_s = time.time() - t_
+
+        g_opt = g_opt.full()
+        failed = self._infeasible_columns(g_opt, np.concatenate((uini, yini)), tol)
+        if failed.size > 0:
+            warnings.warn(f"Solver failed for the columns {failed.tolist()} of the batch, the solutions violate the constraints!")
         u_opt = np.matmul(self.Uf, g_opt)
         return u_opt, g_opt, t_s
+
+    def _infeasible_columns(self, g, uyini, tol):
+        """
+            Indices of the columns of g that violate the equality constraints Up * g = uini (, Yp * g = yini)
+            or the inequality constraints lbc <= Hc * g <= ubc by more than tol, relative to the size of the bounds
+        """
+        n_eq = len(self.lbc) - len(self.lbc_ineq)
+        rhs = uyini[:n_eq]
+        eq_err = np.abs(np.concatenate((self.Up, self.Yp))[:n_eq] @ g - rhs) - tol * (1 + np.abs(rhs))
+        Hc_g = self.Hc @ g
+        lb, ub = self.lbc_ineq[:, None], self.ubc_ineq[:, None]
+        ineq_err = np.maximum(lb - Hc_g - tol * (1 + np.abs(lb)), Hc_g - ub - tol * (1 + np.abs(ub)))
+        violated = np.any(eq_err > 0, axis=0) | np.any(ineq_err > 0, axis=0)
+        return np.flatnonzero(violated | ~np.all(np.isfinite(g), axis=0))
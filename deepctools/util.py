@@ -29,11 +29,59 @@ def hankel(x, L):
 
     T, x_dim = x.shape
 
-    Hx = np.zeros((L * x_dim, T - L + 1))
-    for i in range(L):
-        Hx[i * x_dim:(i + 1) * x_dim, :] = x[i:i + T - L + 1, :].T  # x need transpose to fit the hankel dimension
+    # windows (T-L+1, x_dim, L) are a view of x, the window index is the column of the Hankel matrix
+    w = np.lib.stride_tricks.sliding_window_view(x.astype(float, copy=False), L, axis=0)
+    Hx = np.ascontiguousarray(w.transpose(2, 1, 0).reshape(L * x_dim, T - L + 1))
     return Hx
 
+def hankel_fft(x, L):
+    """
+        ------Precompute the spectrum of x for the FFT-based product H(x) * v------
+        x: data sequence (data_size, x_dim)
+        L: row dimension of the hankel matrix
+        return: Xf: rfft of x along the data axis, with fft length N = 2^ceil(log2(T))
+                    which is long enough to avoid the circular aliasing of H(x) * v
+    """
+    if not isinstance(x, np.ndarray):
+        x = np.array(x)
+
+    T = x.shape[0]
+    N = 1 << int(np.ceil(np.log2(T)))
+    return np.fft.rfft(x, n=N, axis=0)
+
+
+def hankel_matvec(Xf, v, L):
+    """
+        ------Hankel matrix-vector product H(x) * v using FFT------
+        Xf: spectrum of x obtained by hankel_fft(x, L)
+         v: vector (T-L+1, )
+         L: row dimension of the hankel matrix
+        return: H(x) * v  (x_dim*L, )
+                the i-th block row is sum_j x(i+j) v(j), i.e., the correlation of x and v,
+                computed as the convolution of x and reversed v in O(N log N) instead of O(x_dim*L*(T-L+1))
+    """
+    n = v.shape[0]
+    N = 2 * (Xf.shape[0] - 1)
+    Vf = np.fft.rfft(v[::-1], n=N)
+    xv = np.fft.irfft(Xf * Vf[:, None], n=N, axis=0)
+    return xv[n - 1:n - 1 + L].ravel()
+
+
+def sparse_dm(x, density=0.5):
+    """
+        ------Convert a numeric matrix to casadi DM, keeping its structural zeros out of the sparsity------
+        x: numeric matrix
+        density: if the ratio of nonzero entries of x is below density, the zeros are removed from
+                 the sparsity pattern of DM, so that the products with SX only contain the nonzeros
+        return: DM of x
+    """
+    x = np.asarray(x, dtype=float)
+    x_dm = cs.DM(x)
+    if x.size > 0 and np.count_nonzero(x) < density * x.size:
+        x_dm = cs.sparsify(x_dm)
+    return x_dm
+
+
 def safevertcat(x):
     """
     Safer wrapper for Casadi's vertcat.
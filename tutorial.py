@@ -151,6 +151,12 @@ def main1():
         'ipopt.acceptable_tol': 1e-8,
         'ipopt.acceptable_obj_change_tol': 1e-6,
     }
+    if uloss != 'du':  # QP problems are solved by OSQP
+        dpc_opts = {
+            'osqp.max_iter': 4000,
+            'osqp.eps_abs': 1e-6,
+            'print_time': 0,
+        }
     if RDeePC:  # if true: Robust DeePC
         dpc.init_RDeePCsolver(uloss=uloss, opts=dpc_opts)
     else:
@@ -304,6 +310,12 @@ def main2():
         'ipopt.acceptable_tol': 1e-8,
         'ipopt.acceptable_obj_change_tol': 1e-6,
     }
+    if uloss != 'du':  # QP problems are solved by OSQP
+        dpc_opts = {
+            'osqp.max_iter': 4000,
+            'osqp.eps_abs': 1e-6,
+            'print_time': 0,
+        }
     if RDeePC:  # if true: Robust DeePC
         dpc.init_RDeePCsolver(uloss=uloss, opts=dpc_opts)
     else: